@@ -28,6 +28,9 @@ def one_match():
     morning_rule = Morning.create()
     assert morning_rule.match('Ann likes to drink tea with milk.')
     assert morning_rule.what.tea.milk.matched
+    # The compiled grammar matches in a single regex; a mismatch goes through the rules
+    assert not morning_rule.match('Ann likes to drink tea with honey.')
+    assert morning_rule.error.description
 
 
 def main():
@@ -49,7 +52,7 @@ def main():
 
     profile = LineProfiler()
     for class_name, method_name in args.method_spec:
-        class_type = getattr(ruler.rules, class_name)
+        class_type = getattr(ruler, class_name)
         method = getattr(class_type, method_name)
         profile.add_function(method)
     profile.enable()
@@ -1,26 +1,67 @@
 import collections
+import re
+
+# Both str and unicode on Python 2
+_string_types = (str, type(u''))
 
 
 class BaseRule(object):
     """
     The base class of all the rule types.
     """
+    __slots__ = (
+        '_name', '_text', '_start', '_end', 'error', '_mismatch', '_dirty', '_compiled'
+    )
 
     def __init__(self):
         self._name = ''
-        self.matched = None
+        # The match is kept as a span of the matched text and sliced only on demand
+        self._text = ''
+        self._start = 0
+        self._end = -1
         self.error = None
         self._mismatch = Mismatch()
+        # Whether the rule tree may hold a match state since the last reset
+        self._dirty = False
+        # The rule tree compiled into a single regex, see compile()
+        self._compiled = None
 
-    def match(self, text):
+    def match(self, text, memoize=False):
         """
         Attempt to match the text.
         The results of the last match are storred in ``error`` and ``matched`` attributes.
         Each consecutive match overrides the previous results.
+        :param memoize: Remember the outcome of every compound rule at every position, so that
+                        backtracking never matches the same rule at the same position twice.
+                        Only a rule object appearing more than once in the tree can be
+                        matched twice at a position, so it pays off only for hand-built trees
+                        sharing rules that backtrack a lot; the trees of the grammar objects
+                        never share rules. Each entry snapshots the state of the whole sub-tree
+                        of its rule, so memory and time grow with the tree size times its
+                        depth at every position, quadratic in the depth for deep trees.
         :return: True if the match was successful, False otherwise.
         """
+        return self._match(text, 0, {} if memoize else None) >= 0
+
+    def _match(self, text, pos, memo):
+        """
+        Attempt to match the text starting at position ``pos``.
+        :param memo: Results of the compound rules already matched during the current
+                     top-level match, keyed by the rule identity and the position;
+                     None if the match isn't memoized.
+        :return: The position right after the matched text or -1 on a mismatch.
+        """
         raise NotImplementedError
 
+    @property
+    def matched(self):
+        """
+        The text matched by the last match or None if the rule didn't match.
+        """
+        if self._end < 0:
+            return None
+        return self._text[self._start:self._end]
+
     @property
     def name(self):
         return self._name
@@ -32,7 +73,7 @@ class BaseRule(object):
         self._name = rule_name
 
     def reset_match(self):
-        self.matched = None
+        self._end = -1
         self.error = None
 
     def register_named_subrules(self):
@@ -49,56 +90,223 @@ class BaseRule(object):
         """
         raise NotImplementedError
 
+    def compile(self):
+        """
+        Compile the rule tree into a single regular expression so that a successful
+        match runs entirely inside the regex engine. A mismatch is still reported by the
+        rules themselves. The tree must not be changed after the compilation.
+        After a successful compiled match every rule of the tree reports its match exactly as
+        if the tree wasn't compiled, except that the rules that failed on the way report no
+        error. A tree that can't be compiled as a whole gets its compilable sub-trees compiled.
+        :return: True if the rule tree could be expressed as a single regex, False otherwise.
+        """
+        return False
+
+    def _clone_compiled(self):
+        """
+        Clone the rule tree along with its compiled regexes.
+        """
+        twin = self.clone()
+        twins = dict(zip(self._tree(), twin._tree()))
+        for rule, rule_twin in twins.items():
+            if rule._compiled is not None:
+                regex, groups = rule._compiled
+                rule_twin._compiled = (regex, [(twins[r], group) for r, group in groups])
+        return twin
+
+    def _tree(self):
+        """
+        :return: A list of all the rules in the rule tree, in pre-order.
+        """
+        return [self]
+
+    def _to_regex(self, groups):
+        """
+        Express the rule as a regex whose match has the rule's matching semantics: once
+        matched, the regex must not backtrack into the rule looking for another match.
+        :param groups: A list to append the (rule, group name) pairs to. Every rule must have
+                       a group, its match is restored from the group; the rule is None for
+                       groups that only serve the matching.
+        :return: The regex text or None if the rule can't be expressed as a regex.
+        """
+        return None
+
+    def _first_chars(self):
+        """
+        Find the characters a match of the rule may start with.
+        :return: A frozenset of the characters or None if they can't be determined or if
+                 the rule may match an empty text.
+        """
+        return None
+
+    def _optimize(self):
+        """
+        Rewrite the rule tree into an equivalent one that matches faster.
+        Must be called only once the names of all the rules in the tree are final.
+        """
+
 
 class BaseCompoundRule(BaseRule):
     """
     The base class of all the rules composed of sub-rules.
     """
+    # Named sub-rules act as member variables stored in the instance dict, see
+    # _collect_named_subrules()
+    __slots__ = ('__dict__', '_named_rules', '_flat_tree', '_rules')
+
     def __init__(self, default_rule_type, *rules):
         super(BaseCompoundRule, self).__init__()
 
         self._named_rules = {}
-        self._rules = []
-        for rule in rules:
-            if str(rule) == rule:
-                self._rules.append(default_rule_type(rule))
-            else:
-                self._rules.append(rule)
-        self.register_named_subrules()
+        # The whole rule tree flattened, built on the first reset, see reset_match()
+        self._flat_tree = None
+        self._rules = tuple(
+            default_rule_type(rule) if isinstance(rule, _string_types) else rule
+            for rule in rules
+        )
+        # The sub-rules have already registered their own named sub-rules
+        self._collect_named_subrules()
+
+    def _match(self, text, pos, memo):
+        self._dirty = True
+
+        # Packrat memoization: a rule re-entered at the same position during the
+        # same top-level match restores its previous outcome, along with the matches of
+        # its sub-rules, instead of re-matching
+        if memo is not None:
+            key = (id(self), pos)
+            memoized = memo.get(key)
+            if memoized is not None:
+                end, state = memoized
+                _restore_match_state(text, state)
+                return end
 
-    def match(self, text):
+        if self._compiled is not None:
+            regex, groups = self._compiled
+            m = regex.match(text, pos)
+            if m:
+                spans = m.regs
+                for rule, group in groups:
+                    rule._text = text
+                    rule._start, rule._end = spans[group]
+                    rule.error = None
+                    rule._dirty = True
+                end = m.end()
+                if memo is not None:
+                    memo[key] = (end, self._match_state())
+                return end
+            # Let the rules themselves find out what exactly went wrong
+
+        end = self._match_subrules(text, pos, memo)
+        if memo is not None:
+            memo[key] = (end, self._match_state())
+        return end
+
+    def _match_state(self):
+        """
+        :return: The match state of every rule in the tree, see _restore_match_state().
+        """
+        if self._flat_tree is None:
+            self._flat_tree = self._tree()
+        return [
+            (rule, rule._text, rule._start, rule._end,
+             None if rule.error is None else
+             (rule.error.position, rule.error._details, rule.error._describe))
+            for rule in self._flat_tree
+        ]
+
+    def _match_subrules(self, text, pos, memo):
+        """
+        Match the sub-rules. Called by ``_match`` when the result is not memoized yet.
+        :return: The position right after the matched text or -1 on a mismatch.
+        """
         raise NotImplementedError
 
     def reset_match(self):
-        super(BaseCompoundRule, self).reset_match()
-        for rule in self._rules:
-            rule.reset_match()
+        # A tree that hasn't been matched since it was reset has nothing to reset; that's
+        # the case of the OneOf alternatives not tried in the last few matches
+        if not self._dirty:
+            return
+
+        # Reset the match state of the whole tree in a single flat loop rather than
+        # recursively; the tree doesn't change once matching has started
+        if self._flat_tree is None:
+            self._flat_tree = self._tree()
+        for rule in self._flat_tree:
+            rule._end = -1
+            rule.error = None
+            rule._dirty = False
 
     def register_named_subrules(self):
+        for rule in self._rules:
+            rule.register_named_subrules()
+        return self._collect_named_subrules()
+
+    def _collect_named_subrules(self):
+        """
+        Build the named sub-rules out of those already registered by the sub-rules.
+        """
+        previous_named_rules = self._named_rules
         self._named_rules = {}
 
         for rule in self._rules:
             # If a rule has a name, the rule itself will be added as a named sub-rule;
             # if doesn't have a name, the named sub-rules of the rule will be added as
             # direct named sub-rules, skipping one level
-            subrules = rule.register_named_subrules()
             if rule.name:
                 subrules = {rule.name: rule}
+            elif isinstance(rule, BaseCompoundRule):
+                subrules = rule._named_rules
+            else:
+                subrules = rule.register_named_subrules()
 
             for name, subrule in subrules.items():
-                existing = self._named_rules.get(name)
-                # If more than one named sub-rule with the same name exist, the name
-                # will actually reference a list of rules
-                if existing:
-                    if isinstance(existing, collections.MutableSequence):
-                        existing.append(subrule)
-                    else:
-                        self._named_rules[name] = [existing, subrule]
-                else:
-                    self._named_rules[name] = subrule
+                _register_named_rule(self._named_rules, name, subrule)
+
+        # Member variables are found by the regular attribute lookup. Only the members
+        # added by the previous registration are replaced; the names taken by the rule's
+        # own attributes, including those set by subclasses, remain theirs.
+        members = self.__dict__
+        for name, subrule in previous_named_rules.items():
+            if members.get(name) is subrule:
+                del members[name]
+        cls = type(self)
+        for name, subrule in self._named_rules.items():
+            if not hasattr(cls, name) and name not in members:
+                members[name] = subrule
 
         return self._named_rules
 
+    def compile(self):
+        groups = []
+        pattern = self._to_regex(groups)
+        if pattern is not None:
+            try:
+                regex = re.compile(pattern)
+            except (re.error, AssertionError):
+                # Python 2 asserts when there are more than 100 groups
+                pass
+            else:
+                # The spans are restored by the group numbers, see _match()
+                self._compiled = (regex, [
+                    (rule, regex.groupindex[group]) for rule, group in groups if rule is not None
+                ])
+                return True
+
+        for rule in self._rules:
+            rule.compile()
+        return False
+
+    def _optimize(self):
+        for rule in self._rules:
+            rule._optimize()
+
+    def _tree(self):
+        tree = [self]
+        for rule in self._rules:
+            tree.extend(rule._tree())
+        return tree
+
     def clone(self):
         twin = type(self)(*[rule.clone() for rule in self._rules])
         twin.name = self.name
@@ -112,15 +320,6 @@ class BaseCompoundRule(BaseRule):
             return rule
         return factory
 
-    def __getattr__(self, item):
-        """
-        Named sub-matches act as member variables.
-        """
-        if item in self._named_rules:
-            return self._named_rules[item]
-        else:
-            raise AttributeError(item)
-
     def __repr__(self):
         return '{}(name={}, matched={}, rules={})'.format(
             self.__class__.__name__,
@@ -130,19 +329,93 @@ class BaseCompoundRule(BaseRule):
         )
 
 
+def _register_named_rule(named_rules, name, rule):
+    """
+    :param rule: A rule or a list of rules having the same name.
+    """
+    existing = named_rules.get(name)
+    # If more than one named sub-rule with the same name exist, the name
+    # will actually reference a flat list of rules; the list is copied because
+    # it may belong to the sub-rule
+    if existing:
+        if not isinstance(existing, collections.MutableSequence):
+            existing = [existing]
+        if isinstance(rule, collections.MutableSequence):
+            named_rules[name] = existing + rule
+        else:
+            named_rules[name] = existing + [rule]
+    else:
+        named_rules[name] = rule
+
+
+def _restore_match_state(text, state):
+    """
+    Restore the match state of the rules, as returned by ``_match_state``.
+    """
+    for rule, rule_text, start, end, mismatch in state:
+        rule._text = rule_text
+        rule._start = start
+        rule._end = end
+        rule._dirty = True
+        if mismatch is None:
+            rule.error = None
+        else:
+            rule._mismatch.set(text, *mismatch)
+            rule.error = rule._mismatch
+
+
+def _capture(rule, pattern, groups):
+    """
+    Wrap the regex in a named group capturing the match of the rule.
+    """
+    group = 'r{}'.format(len(groups))
+    groups.append((rule, group))
+    return '(?P<{}>{})'.format(group, pattern)
+
+
+def _atomic(rule, pattern, groups):
+    """
+    Wrap the regex in an emulated atomic group, preventing the regex engine from backtracking
+    into it. Python re matches a lookahead only once, the backreference then consumes its match.
+    """
+    group = 'r{}'.format(len(groups))
+    groups.append((rule, group))
+    return '(?=(?P<{0}>{1}))(?P={0})'.format(group, pattern)
+
+
 class Mismatch(object):
     """
     Describes matching error.
+    Most of the mismatches are discarded by backtracking, so the description is built
+    only when it is actually read.
     """
+    __slots__ = ('text', 'position', '_details', '_describe')
+
     def __init__(self):
         self.text = ''
         self.position = -1
-        self.description = ''
+        self._details = ''
+        self._describe = None
 
-    def set(self, text, position, description):
+    def set(self, text, position, details, describe=None):
+        """
+        :param describe: A function building the description out of ``details``;
+                         if None, ``details`` is the description itself.
+        """
         self.text = text
         self.position = position
-        self.description = description
+        self._details = details
+        self._describe = describe
+
+    def set_from(self, mismatch):
+        self.set(mismatch.text, mismatch.position, mismatch._details, mismatch._describe)
+
+    @property
+    def description(self):
+        if self._describe is not None:
+            self._details = self._describe(self._details)
+            self._describe = None
+        return self._details
 
     @property
     def long_description(self):
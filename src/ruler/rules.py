@@ -1,99 +1,277 @@
 import re
 
-from .base_rules import BaseRule, BaseCompoundRule
+from .base_rules import BaseRule, BaseCompoundRule, _capture, _atomic, _register_named_rule
 
+# Matches the regexes having no special characters
+_LITERAL = re.compile(r'[^.^$*+?{}\[\]\\|()]*\Z')
 
-class Grammar(object):
+# Matches the head of a regex that must start either with a specific character or with
+# a character of a simple ASCII character set
+_HEAD = re.compile(
+    r'(?:\[([\x20-\x5b\x5f-\x7e][\x20-\x5b\x5e-\x7e]*)\]|([^.^$*+?{}\[\]\\|()]))(?![?*{])'
+)
+
+# Compiled regexes shared by all the regex rules, see _compile_regex()
+_regex_cache = {}
+_REGEX_CACHE_SIZE = 4096
+
+# Up to this many OneOf errors are merged without hashing them
+_LINEAR_MERGE_LIMIT = 4
+
+
+def _compile_regex(regex):
+    """
+    Compile and analyze a regex once for all the rules using it.
+    :return: The compiled regex, whether it's embeddable in other regexes and whether
+             it's a literal.
+    """
+    compiled = _regex_cache.get(regex)
+    if compiled is None:
+        if len(_regex_cache) >= _REGEX_CACHE_SIZE:
+            _regex_cache.clear()
+        pattern = re.compile(regex)
+        # Groups and flags of the regex would interfere with an enclosing regex
+        embeddable = not pattern.groups and not pattern.flags & ~re.UNICODE
+        # A literal has only one way to match
+        literal = embeddable and _LITERAL.match(regex) is not None
+        compiled = _regex_cache[regex] = (pattern, embeddable, literal)
+    return compiled
+
+
+def _regex_first_chars(regex):
+    """
+    :return: A frozenset of the characters the regex matches may start with or None if
+             the characters can't be determined.
+    """
+    m = _HEAD.match(regex)
+    # An alternation may start anywhere
+    if not m or '|' in regex:
+        return None
+    if m.group(2):
+        return frozenset(m.group(2))
+
+    chars = set()
+    charset = m.group(1)
+    i = 0
+    while i < len(charset):
+        if charset[i + 1:i + 2] == '-' and i + 2 < len(charset):
+            chars.update(chr(c) for c in range(ord(charset[i]), ord(charset[i + 2]) + 1))
+            i += 3
+        else:
+            chars.add(charset[i])
+            i += 1
+    return frozenset(chars)
+
+
+def _describe_regex_mismatch(details):
+    text, pos, pattern = details
+    if pos < len(text):
+        return '"{}" does not match "{}"'.format(text[pos:], pattern)
+    return 'reached end of line but expected "{}"'.format(pattern)
+
+
+def _join_mismatch_descriptions(errors):
+    # Identical errors were already merged, but different ones may still read the same;
+    # the descriptions keep the order of the sub-rules
+    descriptions = []
+    for details, describe in errors:
+        description = describe(details) if describe is not None else details
+        if description not in descriptions:
+            descriptions.append(description)
+    return '\n'.join(descriptions)
+
+
+class GrammarMeta(type):
+    """
+    Builds the rule tree of a grammar class once, when the class is created.
+    """
+    def __init__(cls, name, bases, namespace):
+        super(GrammarMeta, cls).__init__(name, bases, namespace)
+
+        if cls.grammar is None:
+            cls._template = None
+            return
+
+        # Collect and name member rules.
+        # Walk the bases first so that the subclasses override their attributes.
+        member_rules = {}
+        for klass in reversed(cls.__mro__):
+            for attr_name, attr in vars(klass).items():
+                if isinstance(attr, BaseRule):
+                    member_rules[attr_name] = attr
+                else:
+                    member_rules.pop(attr_name, None)
+
+        # 'grammar' is a reserved name
+        member_rules.pop('grammar', None)
+
+        for attr_name, attr in member_rules.items():
+            attr.name = attr_name
+
+        cls.grammar.register_named_subrules()
+
+        # All the grammar objects are clones of this one
+        cls._template = cls.grammar.clone()
+        cls._template._optimize()
+        cls._template.compile()
+
+
+class Grammar(GrammarMeta('GrammarBase', (object,), {'grammar': None})):
     """
     Rules container.
     This class is intended to be inherited and contain all the rules of a grammar.
     The main purpose of the class is to name the rules and arrange them hierarchically.
 
     The inheriting class must assign the root rule to ``grammar`` attribute.
+    The rules are named and arranged when the inheriting class is created.
     """
     grammar = None
 
     @classmethod
     def create(cls):
-        # Collect and name member rules
-        for attr_name in dir(cls):
-
-            # 'grammar' is a reserved name
-            if attr_name == 'grammar':
-                continue
-
-            attr = getattr(cls, attr_name)
-            if isinstance(attr, BaseRule):
-                attr.name = attr_name
-
-        cls.grammar.register_named_subrules()
-
-        return cls.grammar.clone()
+        return cls._template._clone_compiled()
 
 
 class CompoundRule(BaseCompoundRule):
-    def __init__(self, *rules):
-        super(CompoundRule, self).__init__(RegexRule, *rules)
+    __slots__ = ()
 
-    def match(self, text):
-        raise NotImplementedError
+    def __init__(self, *rules):
+        super(CompoundRule, self).__init__(_string_rule, *rules)
 
 
 class Rule(CompoundRule):
     """
     This rule matches if all of its sub-rules match.
     """
-    def match(self, text):
-        text_to_match = text
+    __slots__ = ('_steps',)
+
+    def __init__(self, *rules):
+        super(Rule, self).__init__(*rules)
+        self._bind_steps()
+
+    def _bind_steps(self):
+        # The sub-rules paired with their bound match methods, so that matching doesn't
+        # look up and bind the methods over and over again
+        self._steps = tuple((rule, rule._match) for rule in self._rules)
+
+    def _match_subrules(self, text, pos, memo):
+        start = pos
 
         # Advance through the text, matching each iteration the next rule
-        for sub_rule in self._rules:
-            # Try to match the next rule
-            if sub_rule.match(text_to_match):
-                # Optional rules return True but might match None
-                if sub_rule.matched is not None:
-                    # Remove the matched part from the text
-                    text_to_match = text_to_match[len(sub_rule.matched):]
-            else:
-                mismatch_position = len(text) - len(text_to_match) + sub_rule.error.position
-                self._mismatch.set(text, mismatch_position, sub_rule.error.description)
+        for sub_rule, sub_match in self._steps:
+            # Optional rules that didn't match return the position unchanged
+            pos = sub_match(text, pos, memo)
+            if pos < 0:
+                self._mismatch.set_from(sub_rule.error)
                 self.error = self._mismatch
-                self.matched = None
-                return False
+                self._end = -1
+                return -1
 
         self.error = None
-        self.matched = text[:-len(text_to_match)] if text_to_match else text
-        return True
+        self._text = text
+        self._start = start
+        self._end = pos
+        return pos
+
+    def _to_regex(self, groups):
+        pattern = self._sequence_to_regex(groups)
+        if pattern is None:
+            return None
+        return _capture(self, pattern, groups)
+
+    def _sequence_to_regex(self, groups):
+        patterns = [rule._to_regex(groups) for rule in self._rules]
+        if None in patterns:
+            return None
+        return ''.join(patterns)
+
+    def _first_chars(self):
+        if not self._rules:
+            return None
+        # A first sub-rule with known first characters can't match an empty text
+        return self._rules[0]._first_chars()
+
+    def _optimize(self):
+        super(Rule, self)._optimize()
+
+        # Inline the unnamed sub-sequences, they have already inlined their own. Their fused
+        # regexes are split back, to be fused along with the neighbouring regexes.
+        inlined = []
+        for rule in self._rules:
+            if type(rule) is Rule and not rule.name:
+                for sub_rule in rule._rules:
+                    if type(sub_rule) is FusedRule:
+                        inlined.extend(sub_rule._rules)
+                    else:
+                        inlined.append(sub_rule)
+            else:
+                inlined.append(rule)
+
+        # Fuse the runs of adjacent regex rules. Only literals, having just one way
+        # to match, may be followed by other regexes inside the fused regex.
+        rules = []
+        run = []
+        for rule in inlined:
+            fusable = type(rule) in (RegexRule, LiteralRule) and rule._embeddable
+            if fusable:
+                run.append(rule)
+            if run and (not fusable or not rule._literal):
+                rules.append(FusedRule(*run) if len(run) > 1 else run[0])
+                run = []
+            if not fusable:
+                rules.append(rule)
+        if run:
+            rules.append(FusedRule(*run) if len(run) > 1 else run[0])
+        self._rules = tuple(rules)
+        self._bind_steps()
 
 
 class RegexRule(BaseRule):
     """
     A rule defined using a regular expression.
     """
+    __slots__ = ('_regex_text', '_regex', '_regex_match', '_embeddable', '_literal')
+
     def __init__(self, regex):
         super(RegexRule, self).__init__()
 
         self._regex_text = regex
-        self._regex = re.compile(regex)
+        self._regex, self._embeddable, self._literal = _compile_regex(regex)
+        # Bound once, called on every match
+        self._regex_match = self._regex.match
 
-    def match(self, text):
-        m = self._regex.match(text)
+    def _match(self, text, pos, memo):
+        m = self._regex_match(text, pos)
         if m:
             self.error = None
-            self.matched = m.group()
-            return True
+            self._text = text
+            self._start = pos
+            self._end = m.end()
+            return self._end
         else:
-            if text:
-                error_text = '"{}" does not match "{}"'.format(text, self._regex.pattern)
-            else:
-                error_text = 'reached end of line but expected "{}"'.format(self._regex.pattern)
-            self._mismatch.set(text, 0, error_text)
+            self._set_mismatch(text, pos, memo)
             self.error = self._mismatch
-            self.matched = None
-            return False
+            self._end = -1
+            return -1
+
+    def _set_mismatch(self, text, pos, memo):
+        self._mismatch.set(text, pos, (text, pos, self._regex_text), _describe_regex_mismatch)
+
+    def _to_regex(self, groups):
+        if not self._embeddable:
+            return None
+        if not self._literal:
+            return _atomic(self, self._regex_text, groups)
+        # A literal has only one way to match, no need to make it atomic
+        return _capture(self, self._regex_text, groups)
+
+    def _first_chars(self):
+        if not self._embeddable:
+            return None
+        return _regex_first_chars(self._regex_text)
 
     def clone(self):
-        twin = RegexRule(self._regex_text)
+        twin = type(self)(self._regex_text)
         twin.name = self.name
         return twin
 
@@ -106,50 +284,362 @@ class RegexRule(BaseRule):
         )
 
 
+class LiteralRule(RegexRule):
+    """
+    A regex rule whose regex has no special characters.
+    The text is compared with the literal directly, without running the regex engine.
+    """
+    __slots__ = ('_length',)
+
+    def __init__(self, literal):
+        super(LiteralRule, self).__init__(literal)
+        self._length = len(literal)
+
+    def _match(self, text, pos, memo):
+        if text.startswith(self._regex_text, pos):
+            self.error = None
+            self._text = text
+            self._start = pos
+            self._end = pos + self._length
+            return self._end
+        else:
+            self._set_mismatch(text, pos, memo)
+            self.error = self._mismatch
+            self._end = -1
+            return -1
+
+
+def _string_rule(regex):
+    """
+    Create the rule of a string sub-rule.
+    """
+    if _compile_regex(regex)[2]:
+        return LiteralRule(regex)
+    return RegexRule(regex)
+
+
+class FusedRule(RegexRule):
+    """
+    A sequence of regex rules matched using a single regex.
+    The named rules of the sequence are captured by groups of the regex.
+    Mismatches are reported by the original rules, exactly as if the sequence wasn't fused.
+    """
+    __slots__ = ('_rules', '_captures')
+
+    def __init__(self, *rules):
+        patterns = []
+        captures = []
+        for rule in rules:
+            if rule.name:
+                patterns.append('({})'.format(rule._regex_text))
+                captures.append((rule, len(captures) + 1))
+            elif rule._literal:
+                patterns.append(rule._regex_text)
+            else:
+                patterns.append('(?:{})'.format(rule._regex_text))
+        super(FusedRule, self).__init__(''.join(patterns))
+        self._rules = rules
+        self._captures = tuple(captures)
+
+    def _match(self, text, pos, memo):
+        m = self._regex_match(text, pos)
+        if m:
+            for rule, group in self._captures:
+                rule.error = None
+                rule._dirty = True
+                rule._text = text
+                rule._start, rule._end = m.span(group)
+            self.error = None
+            self._text = text
+            self._start = pos
+            self._end = m.end()
+            return self._end
+        else:
+            self._set_mismatch(text, pos, memo)
+            self.error = self._mismatch
+            self._end = -1
+            return -1
+
+    def _set_mismatch(self, text, pos, memo):
+        for rule in self._rules:
+            pos = rule._match(text, pos, memo)
+            if pos < 0:
+                break
+        self._mismatch.set_from(rule.error)
+
+    def _tree(self):
+        return [self] + list(self._rules)
+
+    def register_named_subrules(self):
+        named_rules = {}
+        for rule, _ in self._captures:
+            _register_named_rule(named_rules, rule.name, rule)
+        return named_rules
+
+    def _to_regex(self, groups):
+        # The original rules are embedded rather than the fused regex, so that their
+        # matches are restored too
+        return _capture(self, ''.join(rule._to_regex(groups) for rule in self._rules), groups)
+
+    def _first_chars(self):
+        return self._rules[0]._first_chars() or super(FusedRule, self)._first_chars()
+
+    def clone(self):
+        return FusedRule(*[rule.clone() for rule in self._rules])
+
+
 class OneOf(CompoundRule):
     """
     This rule matches if one of its sub-rules matches.
     """
-    def match(self, text):
-        self.matched = None
+    __slots__ = ('_alternation', '_fallback', '_dispatch')
 
-        # Iterate until the first match
-        sub_rules = iter(self._rules)
-        for sub_rule in sub_rules:
-            if sub_rule.match(text):
-                self.matched = sub_rule.matched
+    def __init__(self, *rules):
+        super(OneOf, self).__init__(*rules)
+        self._build_dispatch()
+
+    def _build_dispatch(self):
+        # Alternative regexes are tried by a single regex; nothing follows the alternation,
+        # so the regex engine picks the same alternative as the ordered choice would
+        self._alternation = None
+        if len(self._rules) > 1 and all(
+            isinstance(rule, RegexRule) and rule._embeddable for rule in self._rules
+        ):
+            try:
+                self._alternation = re.compile(
+                    '|'.join('({})'.format(rule._regex_text) for rule in self._rules)
+                ).match
+            except (re.error, AssertionError):
+                # Python 2 asserts when there are more than 100 groups
+                pass
+
+        # Map each possible first character to the sub-rules that may match a text
+        # starting with it; the sub-rules not known to start with a specific character
+        # are candidates for any text
+        first_chars = [rule._first_chars() for rule in self._rules]
+        self._fallback = self._dispatch_entry(
+            r for r, chars in zip(self._rules, first_chars) if chars is None
+        )
+        self._dispatch = {}
+        for char in set().union(*[chars for chars in first_chars if chars is not None]):
+            self._dispatch[char] = self._dispatch_entry(
+                r for r, chars in zip(self._rules, first_chars) if chars is None or char in chars
+            )
+
+    def _dispatch_entry(self, candidates):
+        """
+        :return: The candidates, without repetitions, and the rest of the sub-rules.
+        """
+        unique = []
+        for rule in candidates:
+            # A repeated rule can't match where it has already failed
+            if rule not in unique:
+                unique.append(rule)
+        return tuple(unique), tuple(r for r in self._rules if r not in unique)
+
+    def _optimize(self):
+        # Factor the common prefix out of the runs of adjacent sequences starting with the
+        # same regexes: OneOf(Rule(p, a), Rule(p, b)) becomes OneOf(Rule(p, OneOf(a, b))).
+        # Matching never backtracks into a matched rule, so the prefix matches the same text
+        # in all of them. Only adjacent sequences are factored, keeping the order of the choice.
+        rules = []
+        run = []
+        for rule in self._rules + (None,):
+            if run and _prefix_key(rule, 0) != _prefix_key(run[0], 0):
+                rules.append(_factor_prefix(run) if len(run) > 1 else run[0])
+                run = []
+            if _prefix_key(rule, 0) is not None:
+                run.append(rule)
+            elif rule is not None:
+                rules.append(rule)
+        self._rules = tuple(rules)
+
+        super(OneOf, self)._optimize()
+        self._build_dispatch()
+
+    def _match_subrules(self, text, pos, memo):
+        if self._alternation is not None:
+            m = self._alternation(text, pos)
+            if m:
+                winner = self._rules[m.lastindex - 1]
+                for other_rule in self._rules:
+                    if other_rule is not winner:
+                        other_rule.reset_match()
+                winner.error = None
+                winner._dirty = True
+                winner._text = self._text = text
+                winner._start = self._start = pos
+                winner._end = self._end = m.end()
                 self.error = None
-                break
+                return self._end
 
-        # Reset the matches of the remaining rules
-        for sub_rule in sub_rules:
-            sub_rule.reset_match()
+            # None of the alternatives matches, let each of them describe why without
+            # matching it again
+            for sub_rule in self._rules:
+                sub_rule._set_mismatch(text, pos, memo)
+                sub_rule.error = sub_rule._mismatch
+                sub_rule._end = -1
+            return self._set_furthest_mismatch(text, self._rules)
 
-        if self.matched is not None:
-            return True
+        if pos < len(text):
+            candidates, skipped = self._dispatch.get(text[pos], self._fallback)
         else:
-            furthest_mismatch_position = max((r.error.position for r in self._rules))
-            description = '\n'.join(
-                set((
-                    r.error.description
-                    for r in self._rules
-                    if r.error.position == furthest_mismatch_position
-                ))
-            )
-            self._mismatch.set(text, furthest_mismatch_position, description)
-            self.error = self._mismatch
-            return False
+            candidates, skipped = self._fallback
+
+        # Iterate until the first match
+        for i, sub_rule in enumerate(candidates):
+            end = sub_rule._match(text, pos, memo)
+            if end >= 0:
+                # Reset the matches of the rules that weren't tried
+                for other_rule in candidates[i + 1:]:
+                    other_rule.reset_match()
+                for other_rule in skipped:
+                    other_rule.reset_match()
+
+                self.error = None
+                self._text = text
+                self._start = pos
+                self._end = end
+                return end
+
+        # The skipped rules would have failed right at the current position, so they
+        # contribute to the error only if none of the candidates got any further
+        if not candidates or max((r.error.position for r in candidates)) == pos:
+            for sub_rule in skipped:
+                sub_rule._match(text, pos, memo)
+            failed = self._rules
+        else:
+            for sub_rule in skipped:
+                sub_rule.reset_match()
+            failed = candidates
+        return self._set_furthest_mismatch(text, failed)
+
+    def _set_furthest_mismatch(self, text, failed):
+        """
+        Set the mismatch of the sub-rules that got the furthest.
+        :return: -1
+        """
+        # Collect the errors that got the furthest, in a single pass, merging the identical
+        # ones before any of them is described
+        furthest_mismatch_position = -1
+        furthest_errors = []
+        # A few errors are merged by a linear scan, many by hashing
+        seen = set() if len(failed) > _LINEAR_MERGE_LIMIT else None
+        for sub_rule in failed:
+            error = sub_rule.error
+            if error.position < furthest_mismatch_position:
+                continue
+            if error.position > furthest_mismatch_position:
+                furthest_mismatch_position = error.position
+                furthest_errors = []
+                if seen is not None:
+                    seen = set()
+
+            # The errors of a nested OneOf are merged one by one
+            if error._describe is _join_mismatch_descriptions:
+                errors = error._details
+            else:
+                errors = ((error._details, error._describe),)
+            for furthest_error in errors:
+                if seen is None:
+                    if furthest_error not in furthest_errors:
+                        furthest_errors.append(furthest_error)
+                elif furthest_error not in seen:
+                    seen.add(furthest_error)
+                    furthest_errors.append(furthest_error)
+        self._mismatch.set(
+            text,
+            furthest_mismatch_position,
+            tuple(furthest_errors),
+            _join_mismatch_descriptions
+        )
+        self.error = self._mismatch
+        self._end = -1
+        return -1
+
+    def _first_chars(self):
+        if not self._rules:
+            return None
+        chars = set()
+        for rule in self._rules:
+            rule_chars = rule._first_chars()
+            # Any alternative may match, so all of them must be known
+            if rule_chars is None:
+                return None
+            chars.update(rule_chars)
+        return frozenset(chars)
+
+    def _to_regex(self, groups):
+        patterns = [rule._to_regex(groups) for rule in self._rules]
+        if None in patterns:
+            return None
+        return _atomic(self, '|'.join(patterns), groups)
+
+
+def _prefix_key(rule, i):
+    """
+    :return: What identifies the ``i``-th sub-rule of a sequence as a prefix shared with
+             other sequences, or None if it can't be shared.
+    """
+    # The prefix is kept only once, so it must have no names to appear under
+    if type(rule) is not Rule or rule.name or i >= len(rule._rules):
+        return None
+    sub_rule = rule._rules[i]
+    if type(sub_rule) not in (RegexRule, LiteralRule) or sub_rule.name:
+        return None
+    return sub_rule._regex_text
+
+
+def _factor_prefix(sequences):
+    """
+    Factor the longest common prefix out of unnamed sequences starting with the same regex.
+    :return: The sequence matching like the ordered choice of the sequences.
+    """
+    length = 1
+    while all(
+        _prefix_key(rule, length) is not None and
+        _prefix_key(rule, length) == _prefix_key(sequences[0], length)
+        for rule in sequences
+    ):
+        length += 1
+
+    suffixes = []
+    for rule in sequences:
+        suffix = rule._rules[length:]
+        suffixes.append(suffix[0] if len(suffix) == 1 else Rule(*suffix))
+    return Rule(*sequences[0]._rules[:length] + (OneOf(*suffixes),))
 
 
 class Optional(Rule):
     """
     An optional rule.
     """
+    __slots__ = ('_content_first_chars',)
+
     def __init__(self, *rules):
         super(Optional, self).__init__(*rules)
+        self._content_first_chars = super(Optional, self)._first_chars()
 
-    def match(self, text):
-        if not super(Optional, self).match(text):
+    def _match(self, text, pos, memo):
+        # Skip the sub-rules when they can't match the next character
+        first_chars = self._content_first_chars
+        if first_chars is not None and (pos >= len(text) or text[pos] not in first_chars):
+            self.reset_match()
+            return pos
+
+        end = super(Optional, self)._match(text, pos, memo)
+        if end < 0:
             self.error = None
-            self.matched = None
-        return True
+            return pos
+        return end
+
+    def _first_chars(self):
+        # May match an empty text
+        return None
+
+    def _to_regex(self, groups):
+        pattern = self._sequence_to_regex(groups)
+        if pattern is None:
+            return None
+        # An unmatched optional rule leaves its group unset
+        return _atomic(None, _capture(self, pattern, groups) + '?', groups)
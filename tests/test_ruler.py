@@ -1,8 +1,10 @@
+import re
+
 from pytest import raises
 
 from ruler import Rule, Optional, OneOf, Grammar, RegexRule
 from ruler.base_rules import BaseRule, BaseCompoundRule, RuleNamingError
-from ruler.rules import CompoundRule
+from ruler.rules import CompoundRule, FusedRule, LiteralRule, _regex_cache
 
 
 class TestRegexRule:
@@ -21,6 +23,36 @@ class TestRegexRule:
         assert not r.match('1abcde')
         assert r.error.position == 0
 
+    def test_shared_regexes(self, monkeypatch):
+        assert RegexRule('a+')._regex is RegexRule('a+')._regex
+        assert 'a+' in _regex_cache
+
+        monkeypatch.setattr('ruler.rules._REGEX_CACHE_SIZE', 1)
+        assert RegexRule('shared+').match('sharedd')
+        assert list(_regex_cache) == ['shared+']
+
+    def test_literals(self):
+        r = Rule('juice', '[a-z]+')
+        assert type(r._rules[0]) is LiteralRule
+        assert type(r._rules[1]) is RegexRule
+        assert type(r.clone()._rules[0]) is LiteralRule
+
+        literal = r._rules[0]
+        assert literal.match('juice')
+        assert literal.matched == 'juice'
+        assert not literal.match(' juice')
+        assert literal.error.position == 0
+        assert literal.error.description == '" juice" does not match "juice"'
+        assert not literal.match('jui')
+        assert literal.matched is None
+
+    def test_first_chars(self):
+        assert RegexRule('juice')._first_chars() == {'j'}
+        assert RegexRule(r'a\d')._first_chars() == {'a'}
+        assert RegexRule('[a-c_-]+x')._first_chars() == {'a', 'b', 'c', '_', '-'}
+        for regex in ('', 'a?', 'a*b', 'a{0,2}', 'a|b', r'\d', '[^a]', '.', '(a)', '(?i)a'):
+            assert RegexRule(regex)._first_chars() is None, regex
+
 
 class TestRule:
     def test_simplest_rule(self):
@@ -38,6 +70,22 @@ class TestRule:
         assert r.match('A number: 12345 [xx]')
         assert r.matched == 'A number: 12345 [xx]'
 
+    def test_regex_context(self):
+        # The sub-rules' regexes see the whole text, not just the text left to match
+        assert not Rule('a', '^b').match('ab')
+        assert not Rule('a', r'\bb').match('ab')
+        assert Rule('a', r'\Bb').match('ab')
+        assert Rule('a', '(?<=a)b').match('ab')
+        assert not Rule('a', '(?<!a)b').match('ab')
+
+        class G(Grammar):
+            grammar = Rule('a', OneOf('^b', '(?<=a)c'), Optional(r'\bd'))
+
+        g = G.create()
+        assert not g.match('ab')
+        assert g.match('acd')
+        assert g.matched == 'ac'
+
     def test_chained_simplest_rules(self):
         r = Rule('a', 'b', 'c')
 
@@ -82,6 +130,79 @@ class TestRule:
         assert g.c.matched == 'c33'
         assert g.c.reused.matched == '33'
 
+    def test_reset_match(self):
+        cd = Rule('c', 'd')
+        r = Rule('a', Rule('b', cd))
+        assert r.match('abcd')
+        assert cd.matched == 'cd'
+
+        r.reset_match()
+        assert r.matched is None
+        assert cd.matched is None
+        assert cd.error is None
+
+    def test_reset_after_compiled_match(self):
+        class G(Grammar):
+            a = Rule('a', '[0-9]')
+            b = Rule('b')
+            grammar = Rule(OneOf(a, b), 'x')
+
+        g = G.create()
+        assert g.match('a1x')
+        assert g.a.matched == 'a1'
+        assert not g.match('bz')
+        assert g.a.matched is None
+        assert g.b.matched == 'b'
+
+    def test_repr(self):
+        r = Rule.with_name('r')('a', '.')
+        assert r.match('ab')
+        assert repr(r) == (
+            "Rule(name='r', matched='ab', rules=("
+            "LiteralRule(name='', matched='a', regex='a'), "
+            "RegexRule(name='', matched='b', regex='.')))"
+        )
+
+    def test_slots(self):
+        for rule in (RegexRule('a'), LiteralRule('a'), FusedRule(RegexRule('a'))):
+            assert not hasattr(rule, '__dict__')
+        # Compound rules have an instance dict only to hold their named sub-rules
+        for rule in (Rule('a'), OneOf('a', 'b'), Optional('a')):
+            assert rule.__dict__ == {}
+            rule.match('a')
+            assert rule.__dict__ == {}
+            assert not hasattr(rule.error or rule._mismatch, '__dict__')
+
+    def test_named_rules_as_members(self):
+        a = RegexRule('a')
+        a.name = 'a'
+        clone = RegexRule('c')
+        clone.name = 'clone'
+        r = Rule(a, Rule.with_name('b')('b'), clone)
+
+        assert r.__dict__ == {'a': a, 'b': r._rules[1]}
+        assert r.clone().a.name == 'a'
+        with raises(AttributeError):
+            r.c
+
+    def test_subclass_attributes(self):
+        class Tagged(Rule):
+            def __init__(self, *rules):
+                super(Tagged, self).__init__(*rules)
+                self.tag = 'tagged'
+                self.b = 'own'
+
+        class G(Grammar):
+            a = RegexRule('a')
+            b = RegexRule('b')
+            grammar = Tagged(a, b)
+
+        for r in (G.grammar, G.create()):
+            assert r.tag == 'tagged'
+            assert r.a.name == 'a'
+            assert r.b == 'own'
+            assert r._named_rules['b'].name == 'b'
+
 
 class TestOptionalRule:
     def test_simplest_rule(self):
@@ -114,6 +235,33 @@ class TestOptionalRule:
         assert r.r1.matched is None
         assert r.r2.matched is None
 
+    def test_first_character_reject(self):
+        milk = Rule.with_name('milk')(' with milk')
+        r = Rule('tea', Optional(milk))
+        assert r._rules[1]._content_first_chars == {' '}
+
+        assert r.match('tea with milk')
+        assert r.milk.matched == ' with milk'
+        assert r.match('tea.')
+        assert r.matched == 'tea'
+        assert r.milk.matched is None
+        assert r.match('tea with milk')
+        assert r.match('tea')
+        assert r.milk.matched is None
+
+    def test_skipped_after_compiled_match(self):
+        class G(Grammar):
+            m = Optional('b')
+            a = Rule('a', m, 'c')
+            grammar = OneOf(a, Rule('a', '(x)'))
+
+        g = G.create()
+        assert g.match('abc')
+        assert g.a.m.matched == 'b'
+        assert g.match('ax')
+        assert g.matched == 'ax'
+        assert g.a.m.matched is None
+
 
 class TestOneOfRule:
     def test_simplest_rule(self):
@@ -162,6 +310,119 @@ class TestOneOfRule:
                     'reached end of line but expected "{}"')
         assert r.error.long_description == expected.format(1, 2) or expected.format(2, 1)
 
+    def test_first_character_dispatch(self):
+        r = OneOf(Rule('a', 'b'), Rule.with_name('c')('c'), Optional('d'))
+
+        assert r.match('cd')
+        assert r.matched == 'c'
+        assert r.c.matched == 'c'
+
+        assert r.match('ab')
+        assert r.matched == 'ab'
+        assert r.c.matched is None
+
+        assert r.match('x')
+        assert r.matched == ''
+
+        r = OneOf(Rule('a', 'b'), 'c')
+
+        assert not r.match('ax')
+        assert r.error.position == 1
+        assert r.error.description == '"x" does not match "b"'
+
+        assert not r.match('x')
+        assert r.error.position == 0
+        assert sorted(r.error.description.split('\n')) == [
+            '"x" does not match "a"', '"x" does not match "c"']
+
+        assert not r.match('')
+        assert r.error.position == 0
+
+        r = OneOf('a', Rule())
+        assert r.match('b')
+        assert r.matched == ''
+
+    def test_nested_first_chars(self):
+        assert OneOf('a', Rule('b', 'x'))._first_chars() == {'a', 'b'}
+        assert OneOf('a', Optional('b'))._first_chars() is None
+        assert OneOf()._first_chars() is None
+
+        inner = OneOf('a', 'b')
+        r = OneOf(Rule(inner, 'c'), 'd', Rule('[a-z]'))
+        assert r._dispatch['a'][0] == (r._rules[0], r._rules[2])
+        assert r._dispatch['d'][0] == (r._rules[1], r._rules[2])
+        assert r.match('bc')
+        assert inner.matched == 'b'
+        assert r.match('dc')
+        assert r.matched == 'd'
+        assert inner.matched is None
+
+        o = Optional(OneOf('a', 'b'))
+        assert o._content_first_chars == {'a', 'b'}
+        assert Rule(o, '.').match('c')
+
+    def test_regex_alternation(self):
+        a = RegexRule('a')
+        ab = RegexRule('ab')
+        r = OneOf(a, ab, 'b+')
+        assert r._alternation is not None
+        assert r.match('abc')
+        assert r.matched == 'a'
+        assert a.matched == 'a'
+        assert ab.matched is None
+        assert r.match('bbc')
+        assert r.matched == 'bb'
+        assert a.matched is None
+        assert not r.match('c')
+        assert r.error.position == 0
+        assert len(r.error.description.split('\n')) == 3
+
+    def test_regex_alternation_mismatch(self):
+        r = OneOf(FusedRule(RegexRule('a'), RegexRule('b')), 'b', 'c')
+        assert r._alternation is not None
+        assert not r.match('ax')
+        assert r.error.position == 1
+        assert r.error.description == '"x" does not match "b"'
+
+    def test_regex_alternation_limits(self, monkeypatch):
+        def compile_error(pattern):
+            raise re.error('too many groups')
+
+        rules = RegexRule('a'), RegexRule('b')
+        monkeypatch.setattr(re, 'compile', compile_error)
+        r = OneOf(*rules)
+        assert r._alternation is None
+        assert r.match('b')
+
+    def test_repeated_alternative(self):
+        a = RegexRule('a')
+        r = OneOf(a, 'b', a)
+        assert r.match('a')
+        assert a.matched == 'a'
+        assert not r.match('c')
+        assert r.error.position == 0
+
+    def test_error_outlives_sub_rule_matches(self):
+        a = RegexRule('a')
+        r = OneOf(Rule(a, 'b'), Rule(a, 'c'))
+        assert not r.match('ax')
+        assert not a.match('x')
+        assert r.error.position == 1
+        assert r.error.description == '"x" does not match "b"\n"x" does not match "c"'
+        assert a.error.description == '"x" does not match "a"'
+
+    def test_error_descriptions_order(self):
+        r = OneOf(Rule('a', 'c'), Rule('a', 'b'), Rule('a', 'c'), RegexRule('x'))
+        assert not r.match('ad')
+        assert r.error.description == '"d" does not match "c"\n"d" does not match "b"'
+
+    def test_many_error_descriptions(self):
+        r = OneOf(*[Rule('a', c) for c in 'bcbdcbx'] + [RegexRule('y')])
+        assert not r.match('ae')
+        assert r.error.description == '\n'.join(
+            '"e" does not match "{}"'.format(c) for c in 'bcdx'
+        )
+
     def test_flattening(self):
         r = OneOf(
             'a',
@@ -183,6 +444,75 @@ class TestOneOfRule:
         assert r.d.matched == 'd'
 
 
+class TestMemoization:
+    class CountingRule(Rule):
+        def __init__(self, *rules):
+            super(TestMemoization.CountingRule, self).__init__(*rules)
+            self.calls = 0
+
+        def _match_subrules(self, text, pos, memo):
+            self.calls += 1
+            return super(TestMemoization.CountingRule, self)._match_subrules(text, pos, memo)
+
+    def test_success_is_memoized(self):
+        shared = self.CountingRule('a')
+        r = OneOf(Rule(shared, 'b'), Rule(shared, 'c'))
+
+        assert r.match('ac', memoize=True)
+        assert r.matched == 'ac'
+        assert shared.matched == 'a'
+        assert shared.calls == 1
+
+    def test_mismatch_is_memoized(self):
+        shared = self.CountingRule('a')
+        r = OneOf(Rule(shared, 'b'), Rule(shared, 'c'))
+
+        assert not r.match('xc', memoize=True)
+        assert r.error.position == 0
+        assert shared.matched is None
+        assert shared.error.description == '"xc" does not match "a"'
+        assert shared.calls == 1
+
+    def test_sub_rules_are_restored(self):
+        n = RegexRule('[a-z]')
+        n.name = 'n'
+        s = Rule(n)
+        r = OneOf(Rule(s, s, 'x'), Rule(s, 'y'))
+
+        assert r.match('ay', memoize=True)
+        assert s.matched == 'a'
+        assert n.matched == 'a'
+
+        # The same state as without memoization
+        assert not r.match('a1z', memoize=True)
+        assert (r.error.position, s.matched, n.matched) == (1, 'a', 'a')
+        assert not r.match('a1z')
+        assert (r.error.position, s.matched, n.matched) == (1, 'a', 'a')
+
+    def test_memo_is_per_match(self):
+        shared = self.CountingRule('a')
+        r = Rule(shared, 'b')
+
+        assert r.match('ab', memoize=True)
+        assert r.match('ab', memoize=True)
+        assert shared.calls == 2
+
+    def test_not_memoized_by_default(self):
+        shared = self.CountingRule('a')
+        r = OneOf(Rule(shared, 'b'), Rule(shared, 'c'))
+
+        assert r.match('ac')
+        assert shared.matched == 'a'
+        assert shared.calls == 2
+
+    def test_compiled(self):
+        r = Rule(OneOf(Rule('a', 'b'), Rule('a')), 'c')
+        assert r.compile()
+        assert r.match('ac', memoize=True)
+        assert not r.match('ad', memoize=True)
+        assert r.error.position == 1
+
+
 class TestTokenRedefinitions:
     def test_sibling_redefinition(self):
         r = Rule(Rule.with_name('x')('a'), Rule.with_name('x')('b'))
@@ -191,6 +521,14 @@ class TestTokenRedefinitions:
         assert r.x[0].matched == 'a'
         assert r.x[1].matched == 'b'
 
+    def test_multiple_redefinitions(self):
+        inner = Rule(Rule.with_name('x')('a'), Rule.with_name('x')('b'))
+        r = Rule(inner, Rule.with_name('x')('c'))
+
+        assert r.match('abc')
+        assert [x.matched for x in r.x] == ['a', 'b', 'c']
+        assert [x.matched for x in inner.x] == ['a', 'b']
+
     def test_oneof_sibling_redefinition(self):
         r = OneOf(Rule.with_name('x')('a'), Rule.with_name('x')('b'))
 
@@ -286,6 +624,169 @@ class TestGrammarClass:
         assert not r.match('Peter likes to drink tea with lemon.')
         assert r.error.position == 24
 
+    def test_inheritance(self):
+        class Base(Grammar):
+            a = Rule('a')
+            b = Rule('b')
+            grammar = Rule(a, b)
+
+        class Derived(Base):
+            b = None
+            c = Rule('c')
+            grammar = Rule(Base.a, c)
+
+        assert Base.b.name == 'b'
+        assert Derived.c.name == 'c'
+
+        d = Derived.create()
+        assert d.match('ac')
+        assert d.a.matched == 'a'
+        assert d.c.matched == 'c'
+        assert Derived.create().match('ac')
+        assert Base.create().match('ab')
+
+    def test_grammar_objects_are_independent(self):
+        class G(Grammar):
+            a = Rule('a')
+            grammar = Rule(OneOf(a, 'b'), 'c')
+
+        g1 = G.create()
+        g2 = G.create()
+        assert g1.match('ac')
+        assert g2.match('bc')
+        assert g1.a.matched == 'a'
+        assert g2.a.matched is None
+        assert G.grammar.matched is None
+
+    def test_missing_grammar(self):
+        class G(Grammar):
+            a = Rule('a')
+
+        with raises(AttributeError):
+            G.create()
+
+    def test_fused_regex_rules(self):
+        class G(Grammar):
+            x = Rule('x')
+            grammar = OneOf(Rule('a', 'b', 'c*', 'd', x, 'e', Optional('f', 'g')), 'h')
+
+        g = G.create()
+        fused = g._rules[0]._rules
+        assert [type(r) for r in fused] == [FusedRule, LiteralRule, Rule, LiteralRule, Optional]
+        assert type(fused[4]._rules[0]) is FusedRule
+
+        for r in (g, g.clone()):
+            assert r.match('abccdxefg')
+            assert r.matched == 'abccdxefg'
+            assert r.x.matched == 'x'
+
+            assert r.match('abdxe')
+            assert r.matched == 'abdxe'
+
+            assert not r.match('abcxe')
+            assert r.error.position == 3
+            assert r.error.description == '"xe" does not match "d"'
+
+            assert not r.match('ab')
+            assert r.error.position == 2
+            assert r.error.description == 'reached end of line but expected "d"'
+
+    def test_inlined_sequences(self):
+        class G(Grammar):
+            x = Rule('x')
+            grammar = Rule('a', Rule('b', Rule('c', x)), Optional(Rule('d', 'e')))
+
+        g = G.create()
+        assert [type(r) for r in g._rules] == [FusedRule, Rule, Optional]
+        assert type(g._rules[2]._rules[0]) is FusedRule
+
+        assert g.match('abcxde')
+        assert g.x.matched == 'x'
+        assert not g.match('abcy')
+        assert g.error.position == 3
+        assert g.error.description == '"y" does not match "x"'
+
+    def test_factored_alternatives(self):
+        class G(Grammar):
+            x = Rule('x')
+            y = Rule('a', 'y')
+            grammar = OneOf(
+                Rule('a', 'b', x), Rule('a', 'b', '[0-9]'), Rule('a', 'c'), y, Rule('a', 'e'), 'f'
+            )
+
+        g = G.create()
+        assert [type(r) for r in g._rules] == [Rule, Rule, Rule, LiteralRule]
+        assert g._rules[2]._rules[0]._regex_text == 'ae'
+        factored = g._rules[0]._rules[1]._rules
+        assert type(factored[0]._rules[1]) is OneOf
+
+        for r in (g, g.clone()):
+            assert r.match('abx')
+            assert r.x.matched == 'x'
+            assert r.match('ab1')
+            assert r.matched == 'ab1'
+            assert r.x.matched is None
+            assert r.match('ac')
+            assert r.match('ay')
+            assert r.y.matched == 'ay'
+
+            assert not r.match('abz')
+            assert r.error.position == 2
+            assert r.error.description == '"z" does not match "x"\n"z" does not match "[0-9]"'
+
+            assert not r.match('az')
+            assert r.error.position == 1
+            assert r.error.description == '\n'.join(
+                '"z" does not match "{}"'.format(c) for c in 'bcye'
+            )
+
+        class H(Grammar):
+            grammar = Rule(OneOf(Rule('a', 'b', 'c'), Rule('a', 'b')), 'd')
+
+        h = H.create()
+        assert h.match('abd')
+        assert h.match('abcd')
+        assert not h.match('abc')
+        assert h.error.position == 3
+
+    def test_fused_named_regex_rules(self):
+        class G(Grammar):
+            sign = RegexRule('-')
+            digits = RegexRule(r'\d+')
+            unit = RegexRule('[a-z]+')
+            grammar = Rule(OneOf(Rule(sign, digits), 'x'), ' ', unit, '(!)?')
+
+        g = G.create()
+        assert type(g._rules[0]._rules[0]._rules[0]) is FusedRule
+        assert type(g._rules[1]) is FusedRule
+        assert not g.compile()
+
+        for r in (g, G.create()):
+            assert r.match('-12 cm!')
+            assert r.sign.matched == '-'
+            assert r.digits.matched == '12'
+            assert r.unit.matched == 'cm'
+
+            assert r.match('x m')
+            assert r.sign.matched is None
+            assert r.digits.matched is None
+            assert r.unit.matched == 'm'
+
+            assert not r.match('-12 !')
+            assert r.error.position == 4
+            assert r.error.description == '"!" does not match "[a-z]+"'
+
+    def test_fused_repeated_names(self):
+        class G(Grammar):
+            sp = RegexRule(' ')
+            word = RegexRule('[a-z]+')
+            grammar = Rule(word, sp, word, sp, sp, word)
+
+        g = G.create()
+        assert g.match('ab cd  ef')
+        assert [sp.matched for sp in g.sp] == [' ', ' ', ' ']
+        assert [word.matched for word in g.word] == ['ab', 'cd', 'ef']
+
     def test_empty_rules(self):
         class EmptyGrammar(Grammar):
             a = Rule('')
@@ -309,6 +810,120 @@ class TestGrammarClass:
         assert g.d.b.a[1].matched == ''
 
 
+class TestCompilation:
+    def test_ordered_choice(self):
+        class G(Grammar):
+            grammar = Rule(OneOf('a', 'ab'), 'c')
+
+        g = G.create()
+        assert g.compile()
+        assert g.match('ac')
+        assert not g.match('abc')
+        assert g.error.position == 1
+
+    def test_greedy_optional(self):
+        class G(Grammar):
+            grammar = Rule(Optional('a'), 'a')
+
+        g = G.create()
+        assert g.compile()
+        assert g.match('aa')
+        assert not g.match('a')
+        assert g.error.position == 1
+
+    def test_atomic_regex(self):
+        class G(Grammar):
+            grammar = Rule('a*', 'ab')
+
+        g = G.create()
+        assert g.compile()
+        assert not g.match('aab')
+        assert g.error.position == 2
+
+    def test_named_regex_rules(self):
+        class G(Grammar):
+            digits = RegexRule(r'\d+')
+            letter = RegexRule('a')
+            grammar = Rule(digits, Optional(letter))
+
+        g = G.create()
+        assert g.compile()
+        assert g.match('12a')
+        assert g.digits.matched == '12'
+        assert g.letter.matched == 'a'
+        assert g.match('12')
+        assert g.matched == '12'
+        assert g.letter.matched is None
+
+    def test_unnamed_rules(self):
+        def states(*rules):
+            return [(r.matched, r.error and r.error.position) for r in rules]
+
+        for compiled in (False, True):
+            a, b = Rule('a'), Rule('b')
+            r = OneOf(Rule(a, 'x'), Rule(b, 'y'))
+            if compiled:
+                assert r.compile()
+            assert r.match('ax')
+            assert states(a, b) == [('a', None), (None, None)]
+            assert r.match('by')
+            assert states(a, b) == [(None, None), ('b', None)]
+
+            x = RegexRule('x')
+            r = Rule(RegexRule('[0-9]+'), x)
+            if compiled:
+                assert r.compile()
+            assert not r.match('12y')
+            assert states(x) == [(None, 2)]
+            assert r.match('34x')
+            assert states(x) == [('x', None)]
+
+    def test_not_compilable(self):
+        for r in (Rule('(a)'), OneOf('(a)'), Optional('(a)'), Rule('(?i)a')):
+            assert not r.compile()
+            assert r.match('a')
+            assert r.matched == 'a'
+
+    def test_compilable_sub_trees(self):
+        class G(Grammar):
+            b = RegexRule('b')
+            ab = Rule('a', Optional(b))
+            grammar = Rule(OneOf(ab, 'c'), '(d)')
+
+        g = G.create()
+        assert not g.compile()
+        assert g._compiled is None
+        assert g._rules[0]._compiled is not None
+        assert g.match('abd')
+        assert g.ab.matched == 'ab'
+        assert g.ab.b.matched == 'b'
+        assert g.match('ad')
+        assert g.ab.b.matched is None
+        assert not g.match('abx')
+        assert g.error.position == 2
+
+        # The unnamed rules of the compiled sub-tree are restored as well
+        a, c = g.ab._rules[0], g._rules[0]._rules[1]
+        assert not g.match('x')
+        assert c.matched is None
+        assert c.error.position == 0
+        assert g.match('cd')
+        assert c.matched == 'c'
+        assert c.error is None
+        assert a.matched is None
+        assert g.match('ad')
+        assert a.matched == 'a'
+        assert c.matched is None
+
+    def test_regex_engine_limits(self, monkeypatch):
+        def compile_error(pattern):
+            raise re.error('too many groups')
+
+        r = Rule('a', 'b')
+        monkeypatch.setattr(re, 'compile', compile_error)
+        assert not r.compile()
+
+
 class TestAbstractClasses:
     """Test classes that are not supposed to be used directly."""
 
@@ -318,6 +933,9 @@ class TestAbstractClasses:
             r.match('')
         with raises(NotImplementedError):
             r.clone()
+        assert not r.compile()
+        assert r._to_regex([]) is None
+        assert r._first_chars() is None
 
     def test_compound_rule(self):
         r = CompoundRule('r')